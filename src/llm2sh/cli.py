@@ -1,43 +1,93 @@
 #!/usr/bin/env python3
 
-import argparse
-import os
-import subprocess
+from __future__ import annotations
 
-from typing import List, Optional, Dict, Set, Tuple
+import os
+import sys
 
-from .config import Config
 from .util import ethrow, eprint
-from .dispatchers.DefaultDispatcher import DefaultDispatcher
-from .dispatchers.AnthropicDispatcher import AnthropicDispatcher
+
+# Read subprocess output in 64 KiB chunks, matching the default pipe capacity on Linux
+READ_CHUNK_SIZE = 64 * 1024
+
+# Model providers, keyed by model type:
+#   (dispatcher class, API base URI, config attribute holding the API key,
+#    config attribute that enables the provider, hint when it is missing)
+# An empty URI uses the OpenAI API. The URI of local models is taken from the config.
+PROVIDERS = {
+  'LOCAL': ('DefaultDispatcher', None, 'local_api_key', 'local_uri', 'Requires local LLM API URI'),
+  'OPENAI': ('DefaultDispatcher', '', 'effective_openai_key', 'effective_openai_key', 'Requires OpenAI API key'),
+  'CLAUDE': ('AnthropicDispatcher', None, 'effective_claude_key', 'effective_claude_key', 'Requires Claude API key'),
+  'GROQ': (
+    'DefaultDispatcher', 'https://api.groq.com/openai/v1', 'effective_groq_key', 'effective_groq_key',
+    'Requires Groq API key',
+  ),
+  'CEREBRAS': (
+    'DefaultDispatcher', 'https://api.cerebras.ai/v1', 'effective_cerebras_key', 'effective_cerebras_key',
+    'Requires Cerebras API key',
+  ),
+}
+
+# Available models: (model name, model type, model id)
+MODELS = (
+  ('local', 'LOCAL', 'local'),
+  ('gpt-4o', 'OPENAI', 'gpt-4o'),
+  ('gpt-3.5-turbo-instruct', 'OPENAI', 'gpt-3.5-turbo-instruct'),
+  ('gpt-4-turbo', 'OPENAI', 'gpt-4-turbo'),
+
+  ('claude-3-5-sonnet', 'CLAUDE', 'claude-3-5-sonnet-20240620'),
+  ('claude-3-opus', 'CLAUDE', 'claude-3-opus-20240229'),
+  ('claude-3-sonnet', 'CLAUDE', 'claude-3-sonnet-20240229'),
+  ('claude-3-haiku', 'CLAUDE', 'claude-3-haiku-20240307'),
+
+  ('groq-llama3-8b', 'GROQ', 'llama3-8b-8192'),
+  ('groq-llama3-70b', 'GROQ', 'llama3-70b-8192'),
+  ('groq-mixtral-8x7b', 'GROQ', 'mixtral-8x7b-32768'),
+  ('groq-gemma-7b', 'GROQ', 'gemma-7b-it'),
+
+  ('cerebras-llama3-8b', 'CEREBRAS', 'llama3.1-8b'),
+  ('cerebras-llama3-70b', 'CEREBRAS', 'llama3.1-70b'),
+)
+
+# Column width of the availability status in --list-models, i.e. len('NOT AVAILABLE')
+MAX_JUST_AVAIL = 13
+
+def build_parser():
+  import argparse
+  parser = argparse.ArgumentParser(
+    description='Ask GPT to run a command',
+    usage='llm2sh [options] <request>',
+    add_help = True,
+  )
+
+  parser.add_argument('request', help = 'request for gpt', action='store', nargs='*')
+  # parser.add_argument('--setup', help = 'configure llm2sh', action = 'store_true')
+  parser.add_argument('-c', '--config', help = 'specify config file, (Default: ~/.config/llm2sh/llm2sh.json)',
+                      action = 'store', default = '~/.config/llm2sh/llm2sh.json')
+  parser.add_argument('-d', '--dry-run', help = 'do not run the generated command', action = 'store_true')
+  parser.add_argument('-l', '--list-models', help = 'list available models', action = 'store_true')
+  parser.add_argument('-m', '--model', help = 'specify which model to use', action = 'store')
+  parser.add_argument('-s', '--silent', help = 'don\'t ask bash to output each command before running it.', action = 'store_true')
+  parser.add_argument('-t', '--temperature', help = 'use a custom sampling temperature', action = 'store')
+  parser.add_argument('-v', '--verbose', help = 'print verbose debug information', action = 'store_true')
+  parser.add_argument('-f', '--yolo', '--force', help = 'run whatever GPT wants, without confirmation', action = 'store_true')
+  parser.add_argument('--setup', help = 'Open an editor to the configuration file', action = 'store_true')
+  return parser
 
 class Cli(object):
   def __init__(self):
-    parser = argparse.ArgumentParser(
-      description='Ask GPT to run a command',
-      usage='llm2sh [options] <request>',
-      add_help = True,
-    )
-
-    parser.add_argument('request', help = 'request for gpt', action='store', nargs='*')
-    # parser.add_argument('--setup', help = 'configure llm2sh', action = 'store_true')
-    parser.add_argument('-c', '--config', help = 'specify config file, (Default: ~/.config/llm2sh/llm2sh.json)',
-                        action = 'store', default = '~/.config/llm2sh/llm2sh.json')
-    parser.add_argument('-d', '--dry-run', help = 'do not run the generated command', action = 'store_true')
-    parser.add_argument('-l', '--list-models', help = 'list available models', action = 'store_true')
-    parser.add_argument('-m', '--model', help = 'specify which model to use', action = 'store')
-    parser.add_argument('-s', '--silent', help = 'don\'t ask bash to output each command before running it.', action = 'store_true')
-    parser.add_argument('-t', '--temperature', help = 'use a custom sampling temperature', action = 'store')
-    parser.add_argument('-v', '--verbose', help = 'print verbose debug information', action = 'store_true')
-    parser.add_argument('-f', '--yolo', '--force', help = 'run whatever GPT wants, without confirmation', action = 'store_true')
-    parser.add_argument('--setup', help = 'Open an editor to the configuration file', action = 'store_true')
+    parser = build_parser()
 
     #
     # Load Config
     #
     self.args = parser.parse_args()
     config_file = os.path.expanduser(self.args.config)
-    self.config = self.load_config(config_file)
+
+    # Read-only invocations don't need to write the config back to disk. --setup always does, so
+    # that the editor shows every available field.
+    read_only = self.args.list_models or self.args.dry_run or not self.args.request
+    self.config = self.load_config(config_file, writeback = self.args.setup or not read_only)
 
     # open the config file in the user's preferred text editor
     if self.args.setup:
@@ -45,6 +95,7 @@ class Cli(object):
         eprint('No EDITOR set. Please set the EDITOR environment variable to your preferred text editor')
         return
 
+      import subprocess
       subprocess.run([os.environ['EDITOR'], config_file])
       return
 
@@ -64,7 +115,7 @@ class Cli(object):
 
       # Print additional information if no models are available, i.e. on a fresh install
       # Don't consider local models for this check
-      if len([v for k, v in self.models.items() if k != 'local']) == 0:
+      if not any(k != 'local' for k in self.models):
         eprint("\nNo models are configured. Use `llm2sh --setup` to configure a model.")
         eprint("For first time users, we recommend using Groq Llama3-70b. It's free and provides a good balance between latency and quality.")
         eprint("Sign up for an API key at https://console.groq.com/")
@@ -74,7 +125,7 @@ class Cli(object):
     #
     # Run Request
     #
-    if len(self.args.request) == 0:
+    if not self.args.request:
       parser.print_help()
       return
     self.request_str = ' '.join(self.args.request)
@@ -82,135 +133,108 @@ class Cli(object):
     self.run_request(response)
 
 
-  def load_config(self, config_file: str) -> Config:
-    if not os.path.exists(config_file):
+  def load_config(self, config_file: str, writeback: bool = True) -> "Config":
+    from .config import Config
+
+    # Open the file directly rather than checking for it first, saving a stat on the common path
+    try:
+      config = Config.load_config(config_file)
+    except FileNotFoundError:
       if self.args.verbose:
         eprint(f"[DEBUG] Config file {config_file} not found, creating a new one.")
       config = Config()
-    else:
-      config = Config.load_config(config_file)
 
     # Try to write the config back in case new fields were added.
-    config.save_config(config_file)
+    if writeback:
+      config.save_config(config_file)
     return config
 
 
   def list_models(self):
-    print('Available models:')
-    print(f'Models can be configured via {self.args.config}\n')
+    model_list = self.model_list
+    max_just_name = max(len(model[0]) for model in model_list)
 
-    max_just_name = max([len(module) for (module, _, _, _, _) in self.model_list])
-    max_just_avail = len('NOT AVAILABLE')
-
-    for (model, avail, help, _, model_id) in self.model_list:
-      print(
+    lines = [
+      'Available models:',
+      f'Models can be configured via {self.args.config}\n',
+    ]
+    for (model, avail, model_type, model_id) in model_list:
+      lines.append(
         model.ljust(max_just_name + 2) +
-        ('OK' if avail else 'NOT AVAILABLE').rjust(max_just_avail) +
+        ('OK' if avail else 'NOT AVAILABLE').rjust(MAX_JUST_AVAIL) +
         " | "
-        f"{help} ({model_id})"
+        f"{self.model_status(model_type, avail)} ({model_id})"
       )
 
+    # Render the whole table with a single write
+    sys.stdout.write('\n'.join(lines) + '\n')
 
-  def load_models(self) -> List[Tuple[str, bool, str, str]]:
-    openai_available = len(self.config.effective_openai_key) > 0
-    openai_str = "Ready" if openai_available else f"Requires OpenAI API key"
-
-    claude_available = len(self.config.effective_claude_key) > 0
-    claude_str = "Ready" if claude_available else f"Requires Claude API key"
 
-    groq_available = len(self.config.effective_groq_key) > 0
-    groq_str = "Ready" if groq_available else f"Requires Groq API key"
+  def model_status(self, model_type: str, available: bool) -> str:
+    if not available:
+      return PROVIDERS[model_type][4]
+    if model_type == 'LOCAL':
+      return f"Ready - {self.config.local_uri}"
+    return "Ready"
 
-    cerebras_available = len(self.config.effective_cerebras_key) > 0
-    cerebras_str = "Ready" if cerebras_available else f"Requires Cerebras API key"
 
-    local_available = len(self.config.local_uri) > 0
-    local_str = f"Ready - {self.config.local_uri}" if local_available else f"Requires local LLM API URI"
+  def load_models(self) -> list[tuple[str, bool, str, str]]:
+    # Resolve each provider once, rather than once per model
+    available = {
+      model_type: bool(getattr(self.config, attr))
+      for (model_type, (_, _, _, attr, _)) in PROVIDERS.items()
+    }
 
     return [
-      ('local', local_available, local_str, 'LOCAL', 'local'),
-      ('gpt-4o', openai_available, openai_str, 'OPENAI', 'gpt-4o'),
-      ('gpt-3.5-turbo-instruct', openai_available, openai_str, 'OPENAI', 'gpt-3.5-turbo-instruct'),
-      ('gpt-4-turbo', openai_available, openai_str, 'OPENAI', 'gpt-4-turbo'),
-
-      ('claude-3-5-sonnet', claude_available, claude_str, 'CLAUDE', 'claude-3-5-sonnet-20240620'),
-      ('claude-3-opus', claude_available, claude_str, 'CLAUDE', 'claude-3-opus-20240229'),
-      ('claude-3-sonnet', claude_available, claude_str, 'CLAUDE', 'claude-3-sonnet-20240229'),
-      ('claude-3-haiku', claude_available, claude_str, 'CLAUDE', 'claude-3-haiku-20240307'),
-
-      ('groq-llama3-8b', groq_available, groq_str, 'GROQ', 'llama3-8b-8192'),
-      ('groq-llama3-70b', groq_available, groq_str, 'GROQ', 'llama3-70b-8192'),
-      ('groq-mixtral-8x7b', groq_available, groq_str, 'GROQ', 'mixtral-8x7b-32768'),
-      ('groq-gemma-7b', groq_available, groq_str, 'GROQ', 'gemma-7b-it'),
-
-      ('cerebras-llama3-8b', cerebras_available, cerebras_str, 'CEREBRAS', 'llama3.1-8b'),
-      ('cerebras-llama3-70b', cerebras_available, cerebras_str, 'CEREBRAS', 'llama3.1-70b'),
+      (model, available[model_type], model_type, model_id)
+      for (model, model_type, model_id) in MODELS
     ]
 
 
-  def dispatch_request(self, request: str) -> List[str]:
-    (_, _, _, model_type, model_id) = self.models[self.selected_model]
+  def dispatch_request(self, request: str) -> list[str]:
+    (_, _, model_type, model_id) = self.models[self.selected_model]
     temperature = self.args.temperature or self.config.temperature
 
-    # TOTO: Implement dispatcher selection based on the chosen model
-    if model_type == 'OPENAI':
-      dispatcher = DefaultDispatcher(
-        uri = '',  # Defaults to None, which uses the OpenAI API
-        key = self.config.effective_openai_key,
-        model = model_id,
-        config = self.config,
-        temperature=temperature,
-        verbose=self.args.verbose,
-      )
-    elif model_type == 'CLAUDE':
+    if model_type not in PROVIDERS:
+      ethrow(f"Unknown model type {model_type}")
+    (dispatcher_name, uri, key_attr, _, _) = PROVIDERS[model_type]
+
+    # Local models take the endpoint and model name from the config
+    if model_type == 'LOCAL':
+      uri = self.config.local_uri
+      model_id = self.config.local_model_name
+
+    # Dispatchers are imported lazily so that the LLM SDKs are only loaded when a request is sent.
+    if dispatcher_name == 'AnthropicDispatcher':
+      from .dispatchers.AnthropicDispatcher import AnthropicDispatcher
       dispatcher = AnthropicDispatcher(
-        key = self.config.effective_claude_key,
-        model = model_id,
-        config = self.config,
-        temperature=temperature,
-        verbose=self.args.verbose,
-      )
-    elif model_type == 'GROQ':
-      dispatcher = DefaultDispatcher(
-        uri = 'https://api.groq.com/openai/v1',
-        key = self.config.effective_groq_key,
+        key = getattr(self.config, key_attr),
         model = model_id,
         config = self.config,
         temperature=temperature,
         verbose=self.args.verbose,
       )
-    elif model_type == 'CEREBRAS':
+    else:
+      from .dispatchers.DefaultDispatcher import DefaultDispatcher
       dispatcher = DefaultDispatcher(
-        uri = 'https://api.cerebras.ai/v1',
-        key = self.config.effective_cerebras_key,
+        uri = uri,
+        key = getattr(self.config, key_attr),
         model = model_id,
         config = self.config,
         temperature=temperature,
         verbose=self.args.verbose,
       )
-    elif model_type == 'LOCAL':
-      dispatcher = DefaultDispatcher(
-        uri = self.config.local_uri,
-        key = self.config.local_api_key,
-        model = self.config.local_model_name,
-        config = self.config,
-        temperature=temperature,
-        verbose=self.args.verbose,
-      )
-    else:
-      ethrow(f"Unknown model type {model_type}")
 
     return dispatcher.dispatch(request)
 
 
-  def run_request(self, response: List[str]):
+  def run_request(self, response: list[str]):
     if not self.args.dry_run:
       print('You are about to run the following commands:')
     else:
       print('(Dry Run) The LLM suggested these commands:')
 
-    for command in response:
-      print(f'  $ {command}')
+    sys.stdout.write(''.join(f'  $ {command}\n' for command in response))
 
     if self.args.dry_run:
       return
@@ -225,36 +249,39 @@ class Cli(object):
     self.run_commands(response)
 
 
-  def run_commands(self, commands: List[str]):
-    # Create a Popen object with shell=True to run commands in a bash shell
+  def run_commands(self, commands: list[str]):
+    import subprocess
+
+    # Spawn bash directly and feed it the commands over stdin. Going through shell=True would
+    # start an extra /bin/sh just to exec bash.
     process = subprocess.Popen(
         ["bash"],
         stdin=subprocess.PIPE,
         stdout=subprocess.PIPE,
         stderr=subprocess.STDOUT,  # Redirect stderr to stdout
-        text=True,
-        shell=True
     )
 
     # Configure the target shell - abort on errors
-    process.stdin.write('set -e\n')
+    script = ['set -e']
     if not self.args.silent:
-      process.stdin.write('set -o xtrace\n')
-    process.stdin.flush()
+      script.append('set -o xtrace')
+    script.extend(commands)
 
-    # Send all the commands at once and terminate the input stream so
+    # Send all the commands in a single write and terminate the input stream so
     # we don't hang on reading the output
-    for command in commands:
-      process.stdin.write(command + '\n')
-      process.stdin.flush()
+    process.stdin.write(('\n'.join(script) + '\n').encode())
     process.stdin.close()
 
-    # Read the output of the command
-    while process.stdout.readable():
-        output = process.stdout.readline()
-        if not output:
-            break
-        print(output.rstrip())
+    # Read the output of the command in large chunks, as soon as it is available, and pass the
+    # raw bytes straight through to our stdout without a decode/encode round trip.
+    sys.stdout.flush()
+    output = sys.stdout.buffer
+    while True:
+      chunk = process.stdout.read1(READ_CHUNK_SIZE)
+      if not chunk:
+        break
+      output.write(chunk)
+      output.flush()
 
     # Close the stdin and wait for the process to finish
     process.wait()
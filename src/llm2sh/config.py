@@ -1,19 +1,36 @@
 import json
 import os
+import stat
 from io import StringIO
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass, asdict, field
+from functools import cached_property
 
-@dataclass
+# Environment variables used as a fallback for each API key field
+API_KEY_ENV_VARS = {
+  'openai_api_key': 'OPENAI_API_KEY',
+  'claude_api_key': 'ANTHROPIC_API_KEY',
+  'groq_api_key': 'GROQ_API_KEY',
+  'cerebras_api_key': 'CEREBRAS_API_KEY',
+}
+
+# Snapshot of the fallback environment variables, taken once at import. The environment doesn't
+# change over the lifetime of the CLI, and a plain dict avoids os.environ's per-lookup encoding work.
+ENV_API_KEYS = {field_name: os.environ.get(env_var, '') for (field_name, env_var) in API_KEY_ENV_VARS.items()}
+
+
+# The effective_* keys are resolved once per instance and cached. Config is frozen, so the cached
+# values cannot go stale. API keys are excluded from the repr to avoid leaking them into logs.
+@dataclass(frozen=True)
 class Config:
   default_model: str = 'groq-llama3-70b'
 
-  openai_api_key: str = ''
-  claude_api_key: str = ''
-  groq_api_key: str = ''
-  cerebras_api_key: str = ''
+  openai_api_key: str = field(default='', repr=False)
+  claude_api_key: str = field(default='', repr=False)
+  groq_api_key: str = field(default='', repr=False)
+  cerebras_api_key: str = field(default='', repr=False)
 
   local_uri: str = 'http://localhost:5000/v1'
-  local_api_key: str = ''
+  local_api_key: str = field(default='', repr=False)
   local_model_name: str = ''
 
   temperature: float = 0.2
@@ -43,51 +60,70 @@ class Config:
     )
 
 
-  @property
+  def _resolve_key(self, field_name: str) -> str:
+    """
+    Returns the API key stored in the given config field, falling back to its environment variable.
+    """
+    return getattr(self, field_name) or ENV_API_KEYS[field_name]
+
+
+  @cached_property
   def effective_openai_key(self) -> str:
-    if len(self.openai_api_key) > 0:
-      return self.openai_api_key
-    elif len(os.environ.get('OPENAI_API_KEY', '')) > 0:
-      return os.environ['OPENAI_API_KEY']
-    else:
-      return ''
+    return self._resolve_key('openai_api_key')
 
 
-  @property
+  @cached_property
   def effective_claude_key(self) -> str:
-    if len(self.claude_api_key) > 0:
-      return self.claude_api_key
-    elif len(os.environ.get('ANTHROPIC_API_KEY', '')) > 0:
-      return os.environ['ANTHROPIC_API_KEY']
-    else:
-      return ''
+    return self._resolve_key('claude_api_key')
 
 
-  @property
+  @cached_property
   def effective_groq_key(self) -> str:
-    if len(self.groq_api_key) > 0:
-      return self.groq_api_key
-    elif len(os.environ.get('GROQ_API_KEY', '')) > 0:
-      return os.environ['GROQ_API_KEY']
-    else:
-      return ''
+    return self._resolve_key('groq_api_key')
 
 
-  @property
+  @cached_property
   def effective_cerebras_key(self) -> str:
-    if len(self.cerebras_api_key) > 0:
-      return self.cerebras_api_key
-    elif len(os.environ.get('CEREBRAS_API_KEY', '')) > 0:
-      return os.environ['CEREBRAS_API_KEY']
-    else:
-      return ''
+    return self._resolve_key('cerebras_api_key')
 
 
   def save_config(self, config_file: str):
+    contents = json.dumps(asdict(self), indent=4)
+
+    # Skip the write entirely if the file on disk is already up to date
+    try:
+      with open(config_file, 'r') as f:
+        if f.read() == contents:
+          return
+    except OSError:
+      pass
+
+    import tempfile
+
     # There are cases where the config location is read-only. Swallow the exception
     try:
-      os.makedirs(os.path.dirname(config_file), exist_ok=True)
-      with open(config_file, 'w') as f:
-        json.dump(asdict(self), f, indent=4)
+      # Resolve symlinks so that the rename below replaces the actual config file, rather than
+      # clobbering a symlink set up by e.g. a dotfile manager.
+      target = os.path.realpath(config_file)
+      config_dir = os.path.dirname(target)
+      os.makedirs(config_dir, exist_ok=True)
+
+      # Write to a temporary file next to the config and atomically swap it in, so an
+      # interrupted write never leaves a truncated config behind.
+      temp_file = None
+      try:
+        with tempfile.NamedTemporaryFile('w', dir=config_dir, delete=False) as f:
+          temp_file = f.name
+          f.write(contents)
+
+        # Keep the permissions of an existing config, rather than the temp file's 0600
+        if os.path.exists(target):
+          os.chmod(temp_file, stat.S_IMODE(os.stat(target).st_mode))
+        os.replace(temp_file, target)
+      except Exception:
+        # Don't leave stray temp files behind, i.e. when the disk is full
+        if temp_file is not None:
+          os.remove(temp_file)
+        raise
     except Exception as e:
       pass
@@ -38,7 +38,7 @@ class AnthropicDispatcher(DefaultDispatcher):
     if self.verbose:
       eprint(f"[DEBUG]: Response:\n{response}")
 
-    return self._clean_output(response.split('\n'))
+    return self._clean_output(response)
 
 
   def _max_context_length(self) -> int:
@@ -1,8 +1,10 @@
 #!/usr/bin/env python3
 
 import getpass
+import itertools
 import os
-from typing import List
+from functools import lru_cache
+from typing import List, Optional, Tuple
 import textwrap
 
 from openai import OpenAI
@@ -11,6 +13,83 @@ from openai.types.chat.chat_completion_message import ChatCompletionMessage
 from ..config import Config
 from ..util import unquote_all, eprint
 
+
+# Common junk environment variables that are not useful to the LLM, omitted by name.
+OMIT_ENV_NAMES = frozenset({
+  # Terminal color settings
+  'color_prompt', 'force_color_prompt',
+  'COLORTERM', 'LSCOLORS', 'LS_COLORS', 'LS_OPTIONS', 'CLICOLOR',
+
+  # GUI & Auth implementation details
+  'SESSION_MANAGER', 'TERM_PROGRAM_VERSION', 'VDPAU_DRIVER',
+  'SSH_AUTH_SOCK', 'SYSTEMD_EXEC_PID', 'XAUTHORITY',
+
+  # Misc others
+  'MOTD_SHOWN', 'PYTHONSTARTUP', 'INVOCATION_ID'
+})
+
+# Environment variable prefixes to omit, checked with a single str.startswith call.
+OMIT_ENV_PREFIXES = (
+  # Inserted when running in a VSCode terminal
+  'VSCODE_',
+
+  # Color codes
+  'COLOR_',
+
+  # Misc others
+  'XDG_', 'DBUS_', 'GJS_', 'GDM_', 'GIO_',
+)
+
+# The current user can't change while we run, so it is only looked up once, at import
+CURRENT_USER = getpass.getuser()
+
+# Quotes that LLMs commonly wrap around the commands they output
+OUTPUT_QUOTES = ('`', '"', "'")
+
+# Heuristic: Output lines to drop entirely - empty lines and code blocks
+SKIP_OUTPUT_LINES = frozenset({'', '```', '```bash', '```shell', '```sh'})
+
+# Heuristic: Drop lines where the LLM is trying to be conversational, i.e. "Sure! Here is..." or "Here is..."
+CONVERSATIONAL_PREFIXES = ('Sure', 'Here')
+
+
+@lru_cache(maxsize=8)
+def _openai_client(base_url: Optional[str], api_key: str) -> OpenAI:
+  """
+  Returns an OpenAI client for the given endpoint. Constructing a client sets up an HTTP connection
+  pool and SSL context, so clients are reused across dispatches to the same endpoint.
+  """
+  return OpenAI(base_url=base_url, api_key=api_key)
+
+
+@lru_cache(maxsize=1)
+def _os_description() -> str:
+  """
+  Returns a description of the OS distro, or an empty string if it cannot be determined.
+  The OS doesn't change while we run, so this is only looked up once per process.
+  """
+
+  # Prefer reading /etc/os-release directly over forking lsb_release
+  try:
+    with open('/etc/os-release', 'r') as f:
+      for line in f:
+        if line.startswith('PRETTY_NAME='):
+          return unquote_all(line[len('PRETTY_NAME='):].strip(), ('"', "'"))
+  except OSError:
+    pass
+
+  if os.path.exists('/usr/bin/lsb_release'):
+    import subprocess
+    try:
+      return subprocess.run(
+        ['/usr/bin/lsb_release', '-d'], capture_output=True, text=True, timeout=1,
+      ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+      pass
+
+  return ''
+
+
 class DefaultDispatcher:
   """
   Default fallback dispatcher for llm2sh, used when there isn't a more specific
@@ -18,6 +97,33 @@ class DefaultDispatcher:
   system prompt or to use a different API.
   """
 
+  # Dedented once when the class is defined, rather than on every prompt build
+  SYSTEM_PROMPT_TEMPLATE = textwrap.dedent("""
+    You are an AI helping the user perform tasks in a Bash shell. The user will give you a request,
+    and you will generate one or more shell commands to fulfill that request. You can use any shell constructs,
+    including pipes, redirection, and loops. You can also use any commands available in the shell environment.
+    The shell is configured with `set -e`, so generate appropriate error handling for commands that are allowed
+    to fail.
+
+    The user is currently logged in as `{whoami}` and the current working directory is `{cwd}`.
+
+    The current directory contains the following files:
+    {ls_lines}
+
+    You can refer to the following environment variables:
+    {env_lines}
+
+
+    {additional_context}
+
+    Make sure you output valid shell commands, paying special attention to quoting and escaping.
+    Do not wrap the response in quotes or backticks. If you want to provide additional information,
+    please include it in a shell comment (i.e. `#`) or use `echo`. For more complex tasks, you can
+    use `cat` to write a Python script to a file and then execute it.
+
+    YOU MUST RESPOND WITH ONLY VALID SHELL COMMANDS. DO NOT INCLUDE ANYTHING ELSE IN YOUR RESPONSE.
+  """)
+
   def __init__(self, uri: str, key: str, model: str, config: Config, temperature: float, verbose: bool = False):
     self.uri = uri
     self.key = key
@@ -36,7 +142,7 @@ class DefaultDispatcher:
     if self.verbose:
       eprint(f"[DEBUG]: System prompt:\n{system_prompt}")
 
-    client = OpenAI(
+    client = _openai_client(
       base_url=None if self.uri == '' else self.uri,
       api_key='NA' if self.key == '' else self.key,
     )
@@ -53,7 +159,7 @@ class DefaultDispatcher:
     if self.verbose:
       eprint(f"[DEBUG]: Response:\n{response}")
 
-    return self._clean_output(response.split('\n'))
+    return self._clean_output(response)
 
 
   def _max_context_length(self) -> int:
@@ -78,7 +184,7 @@ class DefaultDispatcher:
     """
     Returns the current user.
     """
-    return getpass.getuser()
+    return CURRENT_USER
 
 
   def _cwd(self) -> str:
@@ -88,144 +194,111 @@ class DefaultDispatcher:
     return os.getcwd()
 
 
-  def _ls(self, summarize_factor: int) -> List[str]:
+  def _ls(self, limit: Optional[int] = None) -> List[str]:
     """
     Returns the contents of the current working directory.
-    The `summarize_factor` is used to suppress overly long directory listings.
+    If `limit` is given, stop reading the directory after that many entries.
+    Overly long listings are summarized by `_get_system_prompt`.
     """
-    items = os.listdir()
-    return items[:int(len(items) * summarize_factor)]
+    with os.scandir() as it:
+      return [entry.name for entry in itertools.islice(it, limit)]
 
 
-  def _additional_context(self, summarize_factor: int) -> str:
+  def _additional_context(self) -> str:
     """
     Returns additional situational context to be included in the system prompt.
     """
 
     lines = []
 
-    # If lsb_release is available, include the OS version
-    if os.path.exists('/usr/bin/lsb_release'):
+    # If the OS version is known, include it
+    os_description = _os_description()
+    if os_description:
       lines.append('The OS is:')
-      lines.append(os.popen('/usr/bin/lsb_release -d').read().strip())
+      lines.append(os_description)
 
     return '\n'.join(lines)
 
 
-  def _available_env(self, summarize_factor: int) -> List[str]:
+  def _available_env(self) -> List[str]:
     """
     Returns the list of available environment variables.
-    The `summarize_factor` is used to limit the number of results.
-    This method also omits some common environment variables that are usually not useful.
-    """
-    items = set(os.environ.keys())
-
-    # Remove common junk environment variables by name. Additional ones are filtered out via patterns.
-    omit = {
-      # Terminal color settings
-      'color_prompt', 'force_color_prompt',
-      'COLORTERM', 'LSCOLORS', 'LS_COLORS', 'LS_OPTIONS', 'CLICOLOR',
-
-      # GUI & Auth implementation details
-      'SESSION_MANAGER', 'TERM_PROGRAM_VERSION', 'VDPAU_DRIVER',
-      'SSH_AUTH_SOCK', 'SYSTEMD_EXEC_PID', 'XAUTHORITY',
-
-      # Misc others
-      'MOTD_SHOWN', 'PYTHONSTARTUP', 'INVOCATION_ID'
-    }
-    items = items - omit
-    items = [
-      i for i in items
-      if (
-        # Inserted when running in a VSCode terminal
-        (not i.startswith('VSCODE_'))
-
-        # Color codes
-        and (not i.startswith('COLOR_'))
-
-        # Misc others
-        and (not i.startswith('XDG_'))
-        and (not i.startswith('DBUS_'))
-        and (not i.startswith('GJS_'))
-        and (not i.startswith('GDM_'))
-        and (not i.startswith('GIO_'))
-      )
+    This method omits some common environment variables that are usually not useful.
+    Overly long lists are summarized by `_get_system_prompt`.
+    """
+    return [
+      i for i in os.environ.keys()
+      if i not in OMIT_ENV_NAMES and not i.startswith(OMIT_ENV_PREFIXES)
     ]
 
-    # Always keep a minimum of 20 items - there's more opportunity to remove items from the
-    # directory contents listing than the environment variables listing.
-    take_n = max(int(len(items) * summarize_factor), 20)
-    return items[:take_n]
-
 
   def _get_system_prompt(self, request_str: str) -> str:
     """
     Returns the system prompt.
     """
     max_length = self._max_system_prompt_length(request_str)
-    summarize_factor = 1.0  # Percentage of the env and directory information to include in the prompt
-
-    def get_prompt(factor: float) -> str:
-      nl = '\n'
-      return textwrap.dedent(f"""
-        You are an AI helping the user perform tasks in a Bash shell. The user will give you a request,
-        and you will generate one or more shell commands to fulfill that request. You can use any shell constructs,
-        including pipes, redirection, and loops. You can also use any commands available in the shell environment.
-        The shell is configured with `set -e`, so generate appropriate error handling for commands that are allowed
-        to fail.
-
-        The user is currently logged in as `{self._whoami()}` and the current working directory is `{self._cwd()}`.
-
-        The current directory contains the following files: \n{nl.join([f"         - {i}" for i in self._ls(factor)])}
-
-        You can refer to the following environment variables: \n{nl.join([f"         - {i}" for i in self._available_env(factor)])}
-
-        \n{self._additional_context(factor)}
 
-        Make sure you output valid shell commands, paying special attention to quoting and escaping.
-        Do not wrap the response in quotes or backticks. If you want to provide additional information,
-        please include it in a shell comment (i.e. `#`) or use `echo`. For more complex tasks, you can
-        use `cat` to write a Python script to a file and then execute it.
-
-        YOU MUST RESPOND WITH ONLY VALID SHELL COMMANDS. DO NOT INCLUDE ANYTHING ELSE IN YOUR RESPONSE.
-      """)
+    # Gather the context once, and only re-slice it while shrinking the prompt
+    whoami = self._whoami()
+    cwd = self._cwd()
+
+    # Each listed file takes at least 5 characters (" - x\n"), so there's no point reading more
+    # entries than could ever fit. This bounds the work in very large directories.
+    ls_full = self._ls(limit=max(max_length, 0) * 4 // 5 + 1)
+    env_full = self._available_env()
+    additional_context = self._additional_context()
+
+    def summarize(factor: float) -> Tuple[List[str], List[str]]:
+      # Always keep a minimum of 20 environment variables - there's more opportunity to remove
+      # items from the directory contents listing than the environment variables listing.
+      return (ls_full[:int(len(ls_full) * factor)], env_full[:max(int(len(env_full) * factor), 20)])
+
+    def get_prompt(ls: List[str], env: List[str]) -> str:
+      return self.SYSTEM_PROMPT_TEMPLATE.format(
+        whoami=whoami,
+        cwd=cwd,
+        ls_lines='\n'.join([f" - {i}" for i in ls]),
+        env_lines='\n'.join([f" - {i}" for i in env]),
+        additional_context=additional_context,
+      )
 
-    prompt = get_prompt(summarize_factor)
-    while len(prompt) // 4 > max_length:
-      # Reduce the amount of information in the prompt
-      summarize_factor = summarize_factor * 0.9 * (max_length / (len(prompt) // 4))
-      prompt = get_prompt(summarize_factor)
+    prompt = get_prompt(ls_full, env_full)
+    if len(prompt) // 4 <= max_length:
+      return prompt
+
+    # The prompt grows linearly with the env and directory listings, so rather than repeatedly
+    # rebuilding it, measure the fixed part once and solve for the percentage of the listings that fits.
+    base_length = len(get_prompt([], []))
+    listings_length = len(prompt) - base_length
+    summarize_factor = (max_length * 4 - base_length) / listings_length if listings_length > 0 else 0.0
+    summarize_factor = min(max(summarize_factor, 0.0), 1.0)
+    prompt = get_prompt(*summarize(summarize_factor))
+
+    # Item lengths vary and a minimum number of env vars is always kept, so the estimate can still
+    # overshoot. Reduce the amount of information further until it fits, or there is nothing left to remove.
+    min_length = len(get_prompt(*summarize(0.0)))
+    while len(prompt) // 4 > max_length and len(prompt) > min_length:
+      summarize_factor = max(summarize_factor * 0.9 * (max_length / (len(prompt) // 4)), 0.0)
+      prompt = get_prompt(*summarize(summarize_factor))
 
     return prompt
 
 
-  def _clean_output(self, output: List[str]) -> List[str]:
+  def _clean_output(self, output: str) -> List[str]:
     """
-    Cleans the output by removing any leading or trailing whitespace and other common mistakes.
+    Splits the raw LLM output into commands, removing any leading or trailing whitespace and other
+    common mistakes.
     """
 
-    # Remove trailing whitespace. Keep leading whitespace in case the LLM is trying to
-    # generate a Python script or something similar.
-    cleaned = [i.rstrip() for i in output]
-
     cleaned = [
       # Remove quotes around the commands
-      unquote_all(i, ['`', '"', "'"])
+      unquote_all(i, OUTPUT_QUOTES)
 
-      for i in cleaned
+      # Remove trailing whitespace. Keep leading whitespace in case the LLM is trying to
+      # generate a Python script or something similar.
+      for i in (line.rstrip() for line in output.split('\n'))
 
-      if not (
-        # Heuristic: Remove empty lines and code blocks
-        (i == '')
-        or (i == '```')
-        or (i == '```bash')
-        or (i == '```shell')
-        or (i == '```sh')
-
-        # Heuristic: Remove lines where the LLM is trying to be conversational
-        or (i.startswith('Sure'))  # i.e. "Sure! Here is..."
-        or (i.startswith('Here'))  # i.e. "Here is..."
-      )
+      if not (i in SKIP_OUTPUT_LINES or i.startswith(CONVERSATIONAL_PREFIXES))
     ]
 
     return cleaned
@@ -1,11 +1,30 @@
 #!/usr/bin/env python3
 
-import fcntl
+from __future__ import annotations
+
 import os
 import sys
-from typing import List
+
+_instance_locks = []
+
 
 def instance_already_running(label="default"):
+  # On Linux, bind a socket in the abstract namespace. This is a single syscall, leaves nothing
+  # behind in /tmp, and is released automatically by the kernel when the process exits.
+  if sys.platform.startswith('linux'):
+    import socket
+    lock_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+      lock_socket.bind(f"\0llm2sh_instance_{label}")
+    except OSError:
+      lock_socket.close()
+      return True
+
+    # Keep a reference so the socket (and thus the lock) lives as long as the process
+    _instance_locks.append(lock_socket)
+    return False
+
+  import fcntl
   lock_file_pointer = os.open(f"/tmp/instance_{label}.lock", os.O_WRONLY | os.O_CREAT)
 
   try:
@@ -32,12 +51,17 @@ def remove_if_exists(path, *args, **kwargs):
 
 
 def flatten(xs):
+    if not isinstance(xs, (list, tuple)):
+        return [xs]
+
     result = []
-    if isinstance(xs, (list, tuple)):
-        for x in xs:
-            result.extend(flatten(x))
-    else:
-        result.append(xs)
+    stack = [xs]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, (list, tuple)):
+            stack.extend(reversed(x))
+        else:
+            result.append(x)
     return result
 
 
@@ -51,7 +75,11 @@ def unquote(x: str, quote='"') -> str:
   return x
 
 
-def unquote_all(x: str, quotes: List[str]) -> str:
+def unquote_all(x: str, quotes: tuple[str, ...]) -> str:
+  # Fast path: most strings aren't quoted at all, and can be rejected with a single startswith call
+  if not x.startswith(tuple(quotes)):
+    return x
+
   for quote in quotes:
     x = unquote(x, quote)
   return x